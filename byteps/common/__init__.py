@@ -19,73 +19,238 @@ import ctypes
 import os
 import sysconfig
 import atexit
+import collections
+import threading
+
+try:
+    from collections.abc import Sequence as _Sequence
+except ImportError:
+    # Python 2
+    from collections import Sequence as _Sequence
+
+_C_UINT64_P = ctypes.POINTER(ctypes.c_uint64)
+_C_FLOAT_P = ctypes.POINTER(ctypes.c_float)
+_C_INT_P = ctypes.POINTER(ctypes.c_int)
+_GET_SPEED_SNAPSHOT_ARGTYPES = (_C_UINT64_P, _C_FLOAT_P, ctypes.c_int,
+                                _C_INT_P, _C_INT_P)
+
+# what get_pushpull_speed() returns when no entry is queued, as built by
+# PushPullSpeed::GetSpeed() in global.cc
+NO_PUSHPULL_SPEED = (0, -5.0)
+
+
+_EXT_SUFFIX = []
 
 
 def get_ext_suffix():
     """Determine library extension for various versions of Python."""
+    if _EXT_SUFFIX:
+        return _EXT_SUFFIX[0]
+
     ext_suffix = sysconfig.get_config_var('EXT_SUFFIX')
-    if ext_suffix:
-        return ext_suffix
+    if not ext_suffix:
+        ext_suffix = sysconfig.get_config_var('SO')
+    if not ext_suffix:
+        ext_suffix = '.so'
+    _EXT_SUFFIX.append(ext_suffix)
+    return ext_suffix
 
-    ext_suffix = sysconfig.get_config_var('SO')
-    if ext_suffix:
-        return ext_suffix
 
-    return '.so'
+_PATH_CACHE = {}
 
 
 def get_extension_full_path(pkg_path, *args):
     assert len(args) >= 1
-    dir_path = os.path.join(os.path.dirname(pkg_path), *args[:-1])
-    full_path = os.path.join(dir_path, args[-1] + get_ext_suffix())
+    key = (pkg_path, args)
+    full_path = _PATH_CACHE.get(key)
+    if full_path is None:
+        dir_path = os.path.join(os.path.dirname(pkg_path), *args[:-1])
+        full_path = os.path.join(dir_path, args[-1] + get_ext_suffix())
+        _PATH_CACHE[key] = full_path
     return full_path
 
 
+_EXISTS_CACHE = {}
+
+
+def _exists_cached(path):
+    # built extensions do not appear or vanish while the process runs
+    exists = _EXISTS_CACHE.get(path)
+    if exists is None:
+        exists = _EXISTS_CACHE[path] = os.path.exists(path)
+    return exists
+
+
 def check_extension(ext_name, ext_env_var, pkg_path, *args):
     full_path = get_extension_full_path(pkg_path, *args)
-    if not os.path.exists(full_path):
+    if not _exists_cached(full_path):
         raise ImportError(
             'Extension %s has not been built.  If this is not expected, reinstall '
             'BytePS with %s=1 to debug the build error.' % (ext_name, ext_env_var))
 
 
+def aggregate_pushpull_speeds(snapshots, window_ms=10000):
+    """Aggregate push pull speed entries collected from several workers.
+
+    Arguments:
+        snapshots: a list of dicts as returned by
+                   get_pushpull_speeds(as_arrays=True), e.g. one per worker.
+        window_ms: entries whose timestamps fall in the same window are
+                   aggregated together. Defaults to the 10 seconds interval
+                   the speed is recorded at.
+
+    Returns:
+        A dict of numpy arrays, one element per window, sorted by time:
+        'ts' (window start, ms since epoch), 'count' (number of entries),
+        'total' and 'mean' (speed in MegaBytes per second).
+    """
+    import numpy as np
+    if snapshots:
+        ts = np.concatenate([s['ts'] for s in snapshots]).astype(np.uint64)
+        speed = np.concatenate([s['speed'] for s in snapshots]).astype(np.float64)
+    else:
+        ts = np.empty(0, dtype=np.uint64)
+        speed = np.empty(0, dtype=np.float64)
+    if ts.size == 0:
+        return {'ts': ts, 'count': np.empty(0, dtype=np.int64),
+                'total': speed, 'mean': speed}
+
+    window = ts // np.uint64(window_ms)
+    order = np.argsort(window, kind='stable')
+    window = window[order]
+    speed = speed[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(window)) + 1))
+    count = np.diff(np.append(starts, window.size))
+    total = np.add.reduceat(speed, starts)
+    return {'ts': window[starts] * np.uint64(window_ms), 'count': count,
+            'total': total, 'mean': total / count}
+
+
+class PushPullSpeedView(_Sequence):
+    """A read-only sequence of (ms since epoch, speed) push pull speed
+    entries backed by flat ctypes arrays. Entries are only turned into Python
+    tuples when indexed; as_arrays() hands them to numpy without a copy."""
+
+    __slots__ = ('_ts', '_speed', '_n')
+
+    def __init__(self, ts, speed, n):
+        self._ts = ts
+        self._speed = speed
+        self._n = n
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._n))]
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError('push pull speed index out of range')
+        return (self._ts[i], self._speed[i])
+
+    def __repr__(self):
+        return 'PushPullSpeedView(%r)' % self[:]
+
+    def as_arrays(self):
+        """Returns a dict with a uint64 array 'ts' and a float32 array 'speed'."""
+        import numpy as np
+        return {'ts': np.frombuffer(self._ts, dtype=np.uint64, count=self._n),
+                'speed': np.frombuffer(self._speed, dtype=np.float32, count=self._n)}
+
+
+def _update_environ(envs):
+    """Set environment variables, skipping the writes that change nothing."""
+    environ = os.environ
+    for key, value in envs.items():
+        if environ.get(key) != value:
+            environ[key] = value
+
+
 class BytePSBasics(object):
     """Wrapper class for the basic BytePS API."""
 
+    __slots__ = ('C_LIB_CTYPES',
+                 '_c_init', '_c_lazy_init', '_c_shutdown', '_c_suspend', '_c_resume',
+                 '_c_size', '_c_local_size', '_c_rank', '_c_local_rank',
+                 '_c_get_speed', '_c_get_speed_snapshot',
+                 '_tele_cap', '_ts_buf', '_speed_buf', '_actual', '_remaining',
+                 '_speed_queue', '_pump_stop', '_pump_thread')
+
     def __init__(self, pkg_path, *args):
         full_path = get_extension_full_path(pkg_path, *args)
-        self.C_LIB_CTYPES = ctypes.CDLL(full_path, mode=ctypes.RTLD_GLOBAL)
+        # the PyTorch plugin imports c_lib as a regular (RTLD_LOCAL) extension
+        # and relies on this handle to make it, and the libraries it pulls in
+        # (ps-lite, UCX, NCCL), globally visible
+        mode = ctypes.RTLD_GLOBAL
+        if int(os.environ.get('BYTEPS_RTLD_LOCAL', 0)):
+            mode = ctypes.RTLD_LOCAL
+        self.C_LIB_CTYPES = ctypes.CDLL(full_path, mode=mode)
+        self._configure_signatures(self.C_LIB_CTYPES)
+
+        # telemetry buffers are allocated once and reused across polls
+        self._tele_cap = int(os.environ.get('BYTEPS_TELEMETRY_CAP', '1024'))
+        self._alloc_telemetry_buffers(self._tele_cap)
+        self._actual = (ctypes.c_int * 1)()
+        self._remaining = (ctypes.c_int * 1)()
+        self._speed_queue = None
+        self._pump_stop = None
+        self._pump_thread = None
+
+    def _configure_signatures(self, lib):
+        lib.byteps_get_pushpull_speed.restype = ctypes.py_object
+        lib.byteps_get_pushpull_speed_snapshot.argtypes = _GET_SPEED_SNAPSHOT_ARGTYPES
+
+        # cache the function pointers so each call skips the CDLL lookup
+        self._c_init = lib.byteps_init
+        self._c_lazy_init = lib.byteps_lazy_init
+        self._c_shutdown = lib.byteps_shutdown
+        self._c_suspend = lib.byteps_suspend
+        self._c_resume = lib.byteps_resume
+        self._c_size = lib.byteps_size
+        self._c_local_size = lib.byteps_local_size
+        self._c_rank = lib.byteps_rank
+        self._c_local_rank = lib.byteps_local_rank
+        self._c_get_speed = lib.byteps_get_pushpull_speed
+        self._c_get_speed_snapshot = lib.byteps_get_pushpull_speed_snapshot
+
+    def _alloc_telemetry_buffers(self, cap):
+        self._tele_cap = cap
+        self._ts_buf = (ctypes.c_uint64 * cap)()
+        self._speed_buf = (ctypes.c_float * cap)()
 
     def init(self, lazy=True):
         """A function that inits BytePS."""
         atexit.register(self.shutdown)
         if lazy:
-            return self.C_LIB_CTYPES.byteps_lazy_init()
+            return self._c_lazy_init()
         else:
-            return self.C_LIB_CTYPES.byteps_init()
+            return self._c_init()
 
     def shutdown(self):
         """A function that shuts BytePS down."""
-        return self.C_LIB_CTYPES.byteps_shutdown()
+        self.stop_telemetry_pump()
+        return self._c_shutdown()
 
     def suspend(self):
         """A function that suspends BytePS for elastic training."""
-        return self.C_LIB_CTYPES.byteps_suspend()
+        return self._c_suspend()
 
     def resume(self, num_workers, num_servers, global_rank, context=None):
         """A function that restarts BytePS after being suspended, for elastic training."""
         # set DMLC environment variables here
-        os.environ['DMLC_NUM_WORKER'] = str(num_workers)
-        os.environ['DMLC_NUM_SERVER'] = str(num_servers)
-        os.environ['BYTEPS_GLOBAL_RANK'] = str(global_rank)
-        return self.C_LIB_CTYPES.byteps_resume(num_workers, num_servers)
+        _update_environ({'DMLC_NUM_WORKER': str(num_workers),
+                         'DMLC_NUM_SERVER': str(num_servers),
+                         'BYTEPS_GLOBAL_RANK': str(global_rank)})
+        return self._c_resume(num_workers, num_servers)
 
     def size(self):
         """A function that returns the number of BytePS processes.
         Returns:
           An integer scalar containing the number of BytePS processes.
         """
-        size = self.C_LIB_CTYPES.byteps_size()
+        size = self._c_size()
         if size == -1:
             raise ValueError(
                 'BytePS has not been initialized; use bps.init().')
@@ -97,7 +262,7 @@ class BytePSBasics(object):
         Returns:
           An integer scalar containing the number of local BytePS processes.
         """
-        local_size = self.C_LIB_CTYPES.byteps_local_size()
+        local_size = self._c_local_size()
         if local_size == -1:
             raise ValueError(
                 'BytePS has not been initialized; use bps.init().')
@@ -108,7 +273,7 @@ class BytePSBasics(object):
         Returns:
           An integer scalar with the BytePS rank of the calling process.
         """
-        rank = self.C_LIB_CTYPES.byteps_rank()
+        rank = self._c_rank()
         if rank == -1:
             raise ValueError(
                 'BytePS has not been initialized; use bps.init().')
@@ -121,7 +286,7 @@ class BytePSBasics(object):
         Returns:
           An integer scalar with the local BytePS rank of the calling process.
         """
-        local_rank = self.C_LIB_CTYPES.byteps_local_rank()
+        local_rank = self._c_local_rank()
         if local_rank == -1:
             raise ValueError(
                 'BytePS has not been initialized; use bps.init().')
@@ -131,9 +296,103 @@ class BytePSBasics(object):
         """A function that returns the current push pull speed. Speed is
         calculated every 10 seconds.
           Returns:
-            A tuple: (ms since epoch, speed in MegaBytes per second)
+            A tuple: (ms since epoch, speed in MegaBytes per second), or
+            NO_PUSHPULL_SPEED if no entry is queued.
+        """
+        # entries collected by the telemetry pump come first, even after it
+        # was stopped
+        if self._speed_queue:
+            return self._speed_queue.popleft()
+        if self._pump_thread is not None:
+            return NO_PUSHPULL_SPEED
+        return self._c_get_speed()
+
+    def get_pushpull_speeds(self, size=None, as_arrays=False):
+        """A function that drains the queued push pull speed entries in a
+        single call, instead of one entry per get_pushpull_speed() call.
+          Arguments:
+            size: maximum number of entries to fetch. Fetches all queued
+                  entries if None.
+            as_arrays: return the entries as numpy arrays instead of tuples.
+          Returns:
+            A PushPullSpeedView, i.e. a sequence of tuples: (ms since epoch,
+            speed in MegaBytes per second), or, if `as_arrays` is True, a dict
+            with a uint64 array 'ts' and a float32 array 'speed'.
+        """
+        queue = self._speed_queue
+        if queue or self._pump_thread is not None:
+            n = len(queue) if size is None else min(size, len(queue))
+            entries = [queue.popleft() for _ in range(n)]
+            if self._pump_thread is None and (size is None or n < size):
+                # the pump was stopped: what it collected is followed by the
+                # entries queued in the library since
+                entries.extend(self._fetch_pushpull_speeds(
+                    None if size is None else size - n))
+                n = len(entries)
+            view = PushPullSpeedView((ctypes.c_uint64 * n)(*[e[0] for e in entries]),
+                                     (ctypes.c_float * n)(*[e[1] for e in entries]), n)
+        else:
+            view = self._fetch_pushpull_speeds(size)
+        return view.as_arrays() if as_arrays else view
+
+    def _fetch_pushpull_speeds(self, size=None):
+        n = self._fill_pushpull_speeds(size)
+        # copy out of the buffers, they are overwritten by the next poll
+        return PushPullSpeedView((ctypes.c_uint64 * n).from_buffer_copy(self._ts_buf),
+                                 (ctypes.c_float * n).from_buffer_copy(self._speed_buf), n)
+
+    def _fill_pushpull_speeds(self, size=None):
+        max_size = self._tele_cap if size is None else size
+        if max_size > self._tele_cap:
+            self._alloc_telemetry_buffers(max_size)
+        self._c_get_speed_snapshot(self._ts_buf, self._speed_buf, max_size,
+                                   self._actual, self._remaining)
+        n = self._actual[0]
+        if size is None and self._remaining[0] > 0:
+            # more entries were queued than the buffers hold: grow them,
+            # keep what was fetched and append the rest
+            ts_buf, speed_buf = self._ts_buf, self._speed_buf
+            self._alloc_telemetry_buffers(n + self._remaining[0])
+            ctypes.memmove(self._ts_buf, ts_buf, ctypes.sizeof(ctypes.c_uint64) * n)
+            ctypes.memmove(self._speed_buf, speed_buf, ctypes.sizeof(ctypes.c_float) * n)
+            self._c_get_speed_snapshot(
+                ctypes.cast(ctypes.addressof(self._ts_buf)
+                            + ctypes.sizeof(ctypes.c_uint64) * n, _C_UINT64_P),
+                ctypes.cast(ctypes.addressof(self._speed_buf)
+                            + ctypes.sizeof(ctypes.c_float) * n, _C_FLOAT_P),
+                self._tele_cap - n, self._actual, self._remaining)
+            n += self._actual[0]
+        return n
+
+    def start_telemetry_pump(self, interval_s=1.0, cap=1024):
+        """A function that starts a daemon thread which polls the push pull
+        speed every `interval_s` seconds, so that get_pushpull_speed() and
+        get_pushpull_speeds() no longer call into the C library.
+          Arguments:
+            interval_s: polling interval in seconds.
+            cap: maximum number of entries kept; the oldest are dropped.
         """
-        pushpull_speed = self.C_LIB_CTYPES.byteps_get_pushpull_speed
-        pushpull_speed.restype = ctypes.py_object
-        entry = pushpull_speed()
-        return entry
+        if self._pump_thread is not None:
+            return
+        # keep the entries a previous pump collected and nobody read yet
+        self._speed_queue = collections.deque(self._speed_queue or (), maxlen=cap)
+        self._pump_stop = threading.Event()
+
+        def pump():
+            while not self._pump_stop.is_set():
+                self._speed_queue.extend(self._fetch_pushpull_speeds())
+                self._pump_stop.wait(interval_s)
+
+        self._pump_thread = threading.Thread(target=pump, name='BytePSTelemetryPump')
+        self._pump_thread.daemon = True
+        self._pump_thread.start()
+
+    def stop_telemetry_pump(self):
+        """A function that stops the thread started by start_telemetry_pump().
+        The entries it collected are still returned, before the new ones, by
+        get_pushpull_speed() and get_pushpull_speeds()."""
+        if self._pump_thread is None:
+            return
+        self._pump_stop.set()
+        self._pump_thread.join()
+        self._pump_thread = None
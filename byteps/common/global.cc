@@ -747,6 +747,21 @@ std::shared_ptr<SpeedEntry> PushPullSpeed::GetSpeed() {
   return entry;
 }
 
+int PushPullSpeed::GetSpeeds(uint64_t* ts, float* speed, int max_size,
+                             int* remaining) {
+  std::lock_guard<std::mutex> lock(_mtx);
+  int i = 0;
+  while (i < max_size && _data_points.size() > 0) {
+    auto entry = _data_points.front();
+    _data_points.pop();
+    ts[i] = entry->ts;
+    speed[i] = entry->speed;
+    ++i;
+  }
+  *remaining = static_cast<int>(_data_points.size());
+  return i;
+}
+
 bool PushPullSpeed::ShouldRecord() {
   return _should_record;
 }
@@ -233,6 +233,8 @@ class PushPullSpeed {
  public:
   static void RecordSpeed(std::shared_ptr<TensorTableEntry> task);
   static std::shared_ptr<SpeedEntry> GetSpeed();
+  static int GetSpeeds(uint64_t* ts, float* speed, int max_size,
+                       int* remaining);
   static bool ShouldRecord();
 
  private:
@@ -135,6 +135,13 @@ extern "C" PyObject* byteps_get_pushpull_speed() {
   return ret;
 }
 
+extern "C" void byteps_get_pushpull_speed_snapshot(uint64_t* ts, float* speed,
+                                                   int max_size,
+                                                   int* actual_size,
+                                                   int* remaining) {
+  *actual_size = PushPullSpeed::GetSpeeds(ts, speed, max_size, remaining);
+}
+
 Status CheckInitialized() { return BytePSGlobal::CheckInit(); }
 
 void PartitionTensor(
@@ -61,6 +61,14 @@ int byteps_local_size();
 
 extern "C" PyObject* byteps_get_pushpull_speed();
 
+// C interface to drain up to max_size push-pull speed entries into
+// caller-owned buffers under a single lock. The number of entries written
+// is stored in actual_size, the number still queued in remaining.
+extern "C" void byteps_get_pushpull_speed_snapshot(uint64_t* ts, float* speed,
+                                                   int max_size,
+                                                   int* actual_size,
+                                                   int* remaining);
+
 // Below are all for Framework plugins
 Status EnqueueTensor(BPSContext &context, std::shared_ptr<Tensor> input,
                      std::shared_ptr<Tensor> output,
@@ -20,12 +20,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import os
 import warnings
 
 from byteps.tensorflow.compression import Compression
 from byteps.tensorflow.ops import broadcast, _push_pull
-from byteps.tensorflow.ops import init, shutdown, suspend, resume, get_pushpull_speed
+from byteps.tensorflow.ops import init, get_pushpull_speed, NO_PUSHPULL_SPEED
+from byteps.tensorflow.ops import shutdown as _shutdown, suspend as _suspend, resume as _resume
+from byteps.tensorflow.ops import get_pushpull_speeds, start_telemetry_pump, stop_telemetry_pump
+from byteps.tensorflow.ops import aggregate_pushpull_speeds
 from byteps.tensorflow.ops import size, local_size, rank, local_rank
 from byteps.tensorflow.ops import handle_average_backwards_compatibility
 from byteps.tensorflow.util import _executing_eagerly
@@ -37,6 +41,51 @@ Average = "Average"
 Sum = "Sum"
 Adasum = "Adasum"
 
+# size() only changes across shutdown()/suspend()/resume(), so cache it
+# together with the eager divisor constants used for averaging
+_cached_size = None
+_cached_divisors = {}
+
+
+def _byteps_size():
+    global _cached_size
+    if _cached_size is None:
+        _cached_size = size()
+    return _cached_size
+
+
+def _byteps_divisor(dtype):
+    if not _executing_eagerly():
+        return tf.constant(_byteps_size(), dtype=dtype)
+    divisor = _cached_divisors.get(dtype)
+    if divisor is None:
+        divisor = _cached_divisors[dtype] = tf.constant(_byteps_size(), dtype=dtype)
+    return divisor
+
+
+def _invalidate_size_cache():
+    global _cached_size
+    _cached_size = None
+    _cached_divisors.clear()
+
+
+def shutdown():
+    """A function that shuts BytePS down."""
+    _invalidate_size_cache()
+    return _shutdown()
+
+
+def suspend():
+    """A function that suspends BytePS for elastic training."""
+    _invalidate_size_cache()
+    return _suspend()
+
+
+def resume(num_workers, num_servers, global_rank, context=None):
+    """A function that restarts BytePS after being suspended, for elastic training."""
+    _invalidate_size_cache()
+    return _resume(num_workers, num_servers, global_rank, context)
+
 def push_pull(tensor, scope='', average=None, device_dense='', device_sparse='',
               compression=Compression.none, op=None, enable_async=False):
     """Perform an push_pull on a tf.Tensor or tf.IndexedSlices.
@@ -68,17 +117,144 @@ def push_pull(tensor, scope='', average=None, device_dense='', device_sparse='',
     true_op = Sum if op == Average else op
 
     with tf.device(device_dense):
-        byteps_size = tf.cast(size(), dtype=tensor.dtype)
-        tensor_compressed, ctx = compression.compress(tensor)
-        summed_tensor_compressed = _push_pull(tensor_compressed, scope)
-        summed_tensor = compression.decompress(summed_tensor_compressed, ctx)
-        if not enable_async:
-            _div = tf.div if hasattr(tf, 'div') else tf.math.divide
-            new_tensor = (_div(summed_tensor, byteps_size)
-                          if op == Average else summed_tensor)
-        else: # no need to average for async training
-            new_tensor = summed_tensor
-    return new_tensor
+        if compression is Compression.none:
+            summed_tensor = _push_pull(tensor, scope)
+        else:
+            tensor_compressed, ctx = compression.compress(tensor)
+            summed_tensor_compressed = _push_pull(tensor_compressed, scope)
+            summed_tensor = compression.decompress(summed_tensor_compressed, ctx)
+        # no need to average for async training, nor with a single worker
+        if op != Average or enable_async or _byteps_size() == 1:
+            return summed_tensor
+        byteps_size = _byteps_divisor(tensor.dtype.base_dtype)
+        _div = tf.div if hasattr(tf, 'div') else tf.math.divide
+        return _div(summed_tensor, byteps_size)
+
+
+# dtypes accepted by the BytepsPushPull op
+_FUSIBLE_DTYPES = (tf.float32, tf.float16, tf.float64, tf.int32, tf.int64)
+
+
+def _group_push_pull_grads(grads, scope, device_dense='', device_sparse='',
+                           compression=Compression.none, enable_async=False):
+    """Push-pull the gradients as one concatenated tensor per dtype, instead
+    of issuing one push_pull per gradient.
+
+    tf.IndexedSlices, gradients whose shape is not fully defined, dtypes
+    not supported by push_pull and gradients larger than
+    BYTEPS_FUSION_THRESHOLD_MB are push-pulled one by one. None gradients
+    are kept. grads may be a nested structure, which is preserved.
+    """
+    flat_grads = tf.nest.flatten(grads)
+    threshold = _fusion_threshold_bytes()
+    # buckets are numbered in order of first appearance of their dtype, and
+    # stored as parallel lists indexed by bucket id
+    bucket_ids = {}
+    bucket_dtypes, bucket_grads, bucket_shapes, bucket_lens = [], [], [], []
+    # bucket id and position in bucket of every gradient, -1 if not fused
+    bucket_of = [-1] * len(flat_grads)
+    pos_of = [-1] * len(flat_grads)
+    results = [None] * len(flat_grads)
+    for idx, grad in enumerate(flat_grads):
+        if grad is None:
+            continue
+        if isinstance(grad, tf.IndexedSlices) or not grad.shape.is_fully_defined() \
+                or grad.dtype not in _FUSIBLE_DTYPES \
+                or grad.shape.num_elements() * grad.dtype.size > threshold:
+            results[idx] = push_pull(grad, scope,
+                                     device_dense=device_dense,
+                                     device_sparse=device_sparse,
+                                     compression=compression,
+                                     enable_async=enable_async)
+            continue
+        bid = bucket_ids.get(grad.dtype)
+        if bid is None:
+            bid = bucket_ids[grad.dtype] = len(bucket_dtypes)
+            bucket_dtypes.append(grad.dtype)
+            bucket_grads.append([])
+            bucket_shapes.append([])
+            bucket_lens.append([])
+        reshaped_grad = tf.reshape(grad, [-1])
+        bucket_of[idx] = bid
+        pos_of[idx] = len(bucket_grads[bid])
+        bucket_grads[bid].append(reshaped_grad)
+        bucket_shapes[bid].append(grad.shape)
+        # the shape is fully defined, so tf.split gets static sizes
+        bucket_lens[bid].append(grad.shape.num_elements())
+
+    avg_splits = []
+    for bid, dtype in enumerate(bucket_dtypes):
+        concat_grads = tf.concat(bucket_grads[bid], 0,
+                                 name='concat_allreduce_' + dtype.name)
+        avg_grads = push_pull(concat_grads, scope,
+                              device_dense=device_dense,
+                              device_sparse=device_sparse,
+                              compression=compression,
+                              enable_async=enable_async)
+        avg_splits.append(tf.split(avg_grads, bucket_lens[bid]))
+    for idx, bid in enumerate(bucket_of):
+        if bid < 0:
+            continue
+        pos = pos_of[idx]
+        results[idx] = tf.reshape(avg_splits[bid][pos], bucket_shapes[bid][pos])
+    return tf.nest.pack_sequence_as(grads, results)
+
+
+def _densify_indexed_slices(grads):
+    """Converts the IndexedSlices in grads to dense tensors, leaving the other
+    entries (and the input sequence) untouched."""
+    sparse_idxes = [idx for idx, grad in enumerate(grads)
+                    if isinstance(grad, tf.IndexedSlices)]
+    if not sparse_idxes:
+        return grads
+    grads = list(grads)
+    for idx in sparse_idxes:
+        grads[idx] = tf.convert_to_tensor(grads[idx])
+    return grads
+
+
+# defun-compiled push_pull_grads of the eager optimizers, shared by all the
+# optimizers with the same configuration so that each one is traced only once
+_defun_push_pull_grads = {}
+
+
+def _optimizer_push_pull_grads(name, device_dense, device_sparse, compression,
+                               sparse_as_dense, enable_fusion, enable_async):
+    def push_pull_grads(grads):
+        with tf.name_scope(name + "_Push_Pull") as scope:
+            if sparse_as_dense:
+                grads = _densify_indexed_slices(grads)
+
+            if enable_fusion:
+                return _group_push_pull_grads(grads, scope,
+                                              device_dense=device_dense,
+                                              device_sparse=device_sparse,
+                                              compression=compression,
+                                              enable_async=enable_async)
+            return [push_pull(grad, scope,
+                              device_dense=device_dense,
+                              device_sparse=device_sparse,
+                              compression=compression,
+                              enable_async=enable_async)
+                    if grad is not None else grad
+                    for grad in grads]
+
+    if not _executing_eagerly():
+        return push_pull_grads
+    key = (name, device_dense, device_sparse, compression, sparse_as_dense,
+           enable_fusion, enable_async)
+    fn = _defun_push_pull_grads.get(key)
+    if fn is None:
+        fn = _defun_push_pull_grads[key] = tf.contrib.eager.defun(push_pull_grads)
+    return fn
+
+
+def _gradient_fusion_enabled():
+    return int(os.getenv('BYTEPS_TF_GRADIENT_FUSION', 0)) != 0
+
+
+def _fusion_threshold_bytes():
+    return float(os.getenv('BYTEPS_FUSION_THRESHOLD_MB', 16)) * 1024 * 1024
 
 
 try:
@@ -107,6 +283,35 @@ if _global_variables is not None:
 
         return broadcast_variables(_global_variables(), root_rank)
 
+def _bucket_variables(variables):
+    """Groups the variables by dtype for fusion, in buckets of at most
+    BYTEPS_FUSION_THRESHOLD_MB. Variables that cannot be fused (dtype not
+    supported by push_pull, shape not fully defined, or larger than the
+    threshold) get a bucket of their own."""
+    threshold = _fusion_threshold_bytes()
+    # the buckets of every dtype, the last one being filled
+    buckets = collections.OrderedDict()
+    bucket_bytes = {}
+    singles = []
+    for var in variables:
+        dtype = var.dtype.base_dtype
+        if dtype not in _FUSIBLE_DTYPES or not var.shape.is_fully_defined():
+            singles.append([var])
+            continue
+        var_bytes = var.shape.num_elements() * dtype.size
+        if var_bytes > threshold:
+            singles.append([var])
+            continue
+        dtype_buckets = buckets.setdefault(dtype, [[]])
+        if bucket_bytes.get(dtype, 0) + var_bytes > threshold:
+            dtype_buckets.append([])
+            bucket_bytes[dtype] = 0
+        dtype_buckets[-1].append(var)
+        bucket_bytes[dtype] = bucket_bytes.get(dtype, 0) + var_bytes
+    return singles + [bucket for dtype_buckets in buckets.values()
+                      for bucket in dtype_buckets]
+
+
 def broadcast_variables(variables, root_rank, scope=''):
     """Broadcasts variables from root rank to all other processes.
     Arguments:
@@ -115,11 +320,28 @@ def broadcast_variables(variables, root_rank, scope=''):
                    to all other processes.
         scope: the graph name scope
     """
-    if size() <= 1:
+    if _byteps_size() <= 1:
         return tf.group(*variables)
     _assign = tf.assign if hasattr(tf, 'assign') else tf.compat.v1.assign
-    return tf.group(*[_assign(var, broadcast(var, root_rank, scope))
-                      for var in variables])
+    # with fusion, variables of the same dtype are flattened and broadcasted
+    # as one tensor per bucket
+    if _gradient_fusion_enabled():
+        buckets = _bucket_variables(variables)
+    else:
+        buckets = [[var] for var in variables]
+    assign_ops = []
+    for bucket in buckets:
+        if len(bucket) == 1:
+            var = bucket[0]
+            assign_ops.append(_assign(var, broadcast(var, root_rank, scope)))
+            continue
+        concat_vars = tf.concat([tf.reshape(var, [-1]) for var in bucket], 0,
+                                name='concat_broadcast_' + bucket[0].dtype.base_dtype.name)
+        bcast_vars = broadcast(concat_vars, root_rank, scope, is_variable=False)
+        splits = tf.split(bcast_vars, [var.shape.num_elements() for var in bucket])
+        assign_ops.extend(_assign(var, tf.reshape(split, var.shape))
+                          for var, split in zip(bucket, splits))
+    return tf.group(*assign_ops)
 
 try:
     _get_default_graph = tf.get_default_graph
@@ -172,6 +394,13 @@ if _SessionRunHook is not None and _get_default_graph is not None:
         def after_create_session(self, session, coord):
             session.run(self.bcast_op)
 
+try:
+    _LOCAL_VARIABLES = tf.compat.v1.GraphKeys.LOCAL_VARIABLES
+    _Variable = tf.compat.v1.Variable
+except AttributeError:
+    _LOCAL_VARIABLES = tf.GraphKeys.LOCAL_VARIABLES
+    _Variable = tf.Variable
+
 try:
     # TensorFlow 2.x
     _LegacyOptimizer = tf.compat.v1.train.Optimizer
@@ -190,7 +419,7 @@ if _LegacyOptimizer is not None:
 
         def __init__(self, optimizer, name=None, use_locking=False, device_dense='',
                     device_sparse='', compression=Compression.none,
-                    sparse_as_dense=False, op=Average):
+                    sparse_as_dense=False, op=Average, backward_passes_per_step=1):
             if name is None:
                 name = "Distributed{}".format(type(optimizer).__name__)
             super(_DistributedOptimizer, self).__init__(name=name, use_locking=use_locking)
@@ -206,26 +435,23 @@ if _LegacyOptimizer is not None:
                 assert int(os.getenv('DMLC_NUM_WORKER')) > 1, \
                     "Async is only valid for distributed training"
                 print('BytePS: enable asynchronous training')
+                if backward_passes_per_step > 1:
+                    raise ValueError('backward_passes_per_step>1 is not supported yet with '
+                                     'asynchronous training')
 
-            def push_pull_grads(grads):
-                with tf.name_scope(self._name + "_Push_Pull") as scope:
-                    if self._sparse_as_dense:
-                        grads = [tf.convert_to_tensor(grad)
-                                if grad is not None and isinstance(grad, tf.IndexedSlices)
-                                else grad for grad in grads]
+            # gradients are accumulated locally for backward_passes_per_step
+            # passes, then push_pulled and applied once
+            self._backward_passes_per_step = backward_passes_per_step
+            self._aggregated_grads = None
+            self._aggregated_vars = None
+            self._counter = None
+            self._push_pull_step = None
 
-                    return [push_pull(grad, scope,
-                                    device_dense=self._device_dense,
-                                    device_sparse=self._device_sparse,
-                                    compression=self._compression,
-                                    enable_async=self._enable_async)
-                            if grad is not None else grad
-                            for grad in grads]
+            self._enable_fusion = _gradient_fusion_enabled()
 
-            if _executing_eagerly():
-                self._push_pull_grads = tf.contrib.eager.defun(push_pull_grads)
-            else:
-                self._push_pull_grads = push_pull_grads
+            self._push_pull_grads = _optimizer_push_pull_grads(
+                self._name, device_dense, device_sparse, compression,
+                sparse_as_dense, self._enable_fusion, self._enable_async)
 
         def compute_gradients(self, *args, **kwargs):
             """Compute gradients of all trainable variables.
@@ -234,34 +460,117 @@ if _LegacyOptimizer is not None:
             push_pull the gradients before returning them.
             """
             gradients = self._optimizer.compute_gradients(*args, **kwargs)
-            if size() > 1 and not self._enable_async:
-                grads, vars = zip(*gradients)
-                avg_grads = self._push_pull_grads(grads)
-                return list(zip(avg_grads, vars))
+            if self._backward_passes_per_step > 1:
+                return self._aggregate_gradients(gradients)
+            if _byteps_size() > 1 and not self._enable_async:
+                avg_grads = self._push_pull_grads([grad for grad, _ in gradients])
+                return [(avg_grad, var) for avg_grad, (_, var) in zip(avg_grads, gradients)]
             else:
                 return gradients
 
+        def _aggregate_gradients(self, gradients):
+            """Adds the gradients to the local accumulators. Every
+            backward_passes_per_step passes, the accumulated gradients are
+            push_pulled; on the other passes they are returned as is, and
+            apply_gradients() does nothing.
+
+            The accumulators, and the pass counter, belong to the variables of
+            the first call: later calls must have gradients for the same
+            variables.
+            """
+            grads, vars = zip(*gradients)
+            idxes = [i for i, grad in enumerate(grads) if grad is not None]
+            if self._aggregated_vars is not None:
+                if len(idxes) != len(self._aggregated_vars) or \
+                        any(vars[i] is not var for i, var in zip(idxes, self._aggregated_vars)):
+                    raise ValueError(
+                        'backward_passes_per_step>1 requires compute_gradients() to '
+                        'return gradients for the same variables on every call; use '
+                        'one DistributedOptimizer per var_list instead.')
+            with tf.name_scope(self._name + "_Aggregate"):
+                if self._aggregated_grads is None:
+                    self._aggregated_vars = [vars[i] for i in idxes]
+                    self._counter = _Variable(0, dtype=tf.int32, trainable=False,
+                                              name='counter',
+                                              collections=[_LOCAL_VARIABLES])
+                    self._aggregated_grads = [
+                        _Variable(tf.zeros(vars[i].get_shape(), dtype=vars[i].dtype.base_dtype),
+                                  trainable=False, name='aggregated_grad_%d' % i,
+                                  collections=[_LOCAL_VARIABLES])
+                        for i in idxes]
+
+                accumulate_ops = [agg.assign_add(tf.convert_to_tensor(grads[i]))
+                                  for agg, i in zip(self._aggregated_grads, idxes)]
+                with tf.control_dependencies(accumulate_ops):
+                    count = self._counter.assign_add(1)
+                self._push_pull_step = tf.equal(
+                    tf.math.floormod(count, self._backward_passes_per_step), 0)
+
+                def read_aggregated():
+                    return [agg.read_value() for agg in self._aggregated_grads]
+
+                def push_pull_aggregated():
+                    aggregated = read_aggregated()
+                    if _byteps_size() > 1:
+                        return list(self._push_pull_grads(aggregated))
+                    return aggregated
+
+                aggregated = tf.cond(self._push_pull_step, push_pull_aggregated,
+                                     read_aggregated)
+                if not isinstance(aggregated, (list, tuple)):
+                    aggregated = [aggregated]
+
+            results = list(grads)
+            for i, grad in zip(idxes, aggregated):
+                results[i] = grad
+            return list(zip(results, vars))
+
         def apply_gradients(self, *args, **kwargs):
             """Calls this same method on the underlying optimizer."""
+            if self._push_pull_step is not None:
+                # only apply, and restart accumulating, on push_pull steps
+                def apply_and_reset():
+                    apply_ops = self._optimizer.apply_gradients(*args, **kwargs)
+                    with tf.control_dependencies([apply_ops]):
+                        return tf.group(*[agg.assign(tf.zeros_like(agg))
+                                          for agg in self._aggregated_grads])
+
+                return tf.cond(self._push_pull_step, apply_and_reset, tf.no_op)
             if self._enable_async: # async training
                 grads_and_vars = args[0]
                 _, vars = zip(*grads_and_vars)
-                old_tensors = []
-                for var in vars:
-                    old_tensors.append(tf.convert_to_tensor(var))
-                apply_ops = self._optimizer.apply_gradients(*args, **kwargs)
+                # with fusion, the variables of a dtype are snapshotted as one
+                # flat tensor, so that their delta is computed at once
+                buckets = (_bucket_variables(vars) if self._enable_fusion
+                           else [[var] for var in vars])
+
+                def read_bucket(bucket):
+                    if len(bucket) == 1:
+                        return bucket[0].read_value()
+                    return tf.concat([tf.reshape(var.read_value(), [-1]) for var in bucket], 0)
+
+                # snapshot the variables, and make sure the update waits for it
+                old_tensors = [read_bucket(bucket) for bucket in buckets]
+                with tf.control_dependencies(old_tensors):
+                    apply_ops = self._optimizer.apply_gradients(*args, **kwargs)
                 with tf.control_dependencies([apply_ops]):
                     # get the delta
-                    for i, var in enumerate(vars):
-                        old_tensors[i] = tf.subtract(var, old_tensors[i])
+                    deltas = [read_bucket(bucket) - old_tensor
+                              for bucket, old_tensor in zip(buckets, old_tensors)]
 
                     # reuse the _push_pul_grads(), but is transferring parameters
-                    updated_tensors = self._push_pull_grads(old_tensors)
+                    updated_tensors = self._push_pull_grads(deltas)
 
-                    # copy the updated variable back
+                    # copy the updated variable back, without reading it again
                     assign_op_list = []
-                    for i, tensor in enumerate(updated_tensors):
-                        assign_op_list.append(tf.assign(vars[i], tensor))
+                    for bucket, tensor in zip(buckets, updated_tensors):
+                        if len(bucket) == 1:
+                            assign_op_list.append(bucket[0].assign(tensor, read_value=False))
+                            continue
+                        splits = tf.split(tensor, [var.shape.num_elements() for var in bucket])
+                        assign_op_list.extend(var.assign(tf.reshape(split, var.shape),
+                                                         read_value=False)
+                                              for var, split in zip(bucket, splits))
 
                 return control_flow_ops.group(*assign_op_list)
             else:
@@ -313,7 +622,11 @@ def DistributedOptimizer(optimizer, name=None, use_locking=False, device_dense='
       backward_passes_per_step:
         Number of backward passes to perform before calling bps.push_pull
         This allows accumulating updates over multiple mini-batches before
-        reducing and applying them.
+        reducing and applying them. The accumulators are created in the
+        LOCAL_VARIABLES collection. apply_gradients() only updates the
+        variables, and increments global_step, on every
+        backward_passes_per_step-th call. compute_gradients() must then be
+        called with the same var_list every time.
       op:
         The reduction operation to use when combining gradients across
         different ranks.
@@ -322,11 +635,9 @@ def DistributedOptimizer(optimizer, name=None, use_locking=False, device_dense='
         if op == Adasum:
             raise ValueError('op == Adasum is not supported yet with ')
         else:
-            if backward_passes_per_step > 1:
-                raise ValueError('backward_passes_per_step>1 is not supported yet with '
-                                 'op != Adasum')
             return _DistributedOptimizer(optimizer, name, use_locking, device_dense,
-                                        device_sparse, compression, sparse_as_dense, op)
+                                        device_sparse, compression, sparse_as_dense, op,
+                                        backward_passes_per_step)
     elif isinstance(optimizer, tf.keras.optimizers.Optimizer):
         if op == Adasum:
             raise ValueError('op == Adasum is not supported yet with Keras')
@@ -357,13 +668,17 @@ if hasattr(tf, 'GradientTape'):
             self._device_sparse = device_sparse
             self._compression = compression
             self._sparse_as_dense = sparse_as_dense
+            self._enable_fusion = _gradient_fusion_enabled()
 
             def push_pull_grads(grads):
                 with tf.name_scope(self._name + "_Push_Pull") as scope:
                     if self._sparse_as_dense:
-                        grads = [tf.convert_to_tensor(grad)
-                                 if grad is not None and isinstance(grad, tf.IndexedSlices)
-                                 else grad for grad in grads]
+                        grads = _densify_indexed_slices(grads)
+                    if self._enable_fusion:
+                        return _group_push_pull_grads(grads, scope,
+                                                      device_dense=self._device_dense,
+                                                      device_sparse=self._device_sparse,
+                                                      compression=self._compression)
                     return [push_pull(grad, scope,
                                       device_dense=self._device_dense,
                                       device_sparse=self._device_sparse,
@@ -375,7 +690,7 @@ if hasattr(tf, 'GradientTape'):
 
         def gradient(self, target, sources, output_gradients=None):
             gradients = super(self.__class__, self).gradient(target, sources, output_gradients)
-            if size() > 1:
+            if _byteps_size() > 1:
                 avg_grads = self._push_pull_grads(gradients)
                 return avg_grads
             else:
@@ -34,6 +34,7 @@ from tensorflow.python.platform import resource_loader
 
 from byteps.common import get_ext_suffix
 from byteps.common import BytePSBasics as _BytePSBasics
+from byteps.common import NO_PUSHPULL_SPEED, aggregate_pushpull_speeds
 from byteps.tensorflow.util import _executing_eagerly
 import tensorflow as tf
 
@@ -64,6 +65,9 @@ local_size = _basics.local_size
 rank = _basics.rank
 local_rank = _basics.local_rank
 get_pushpull_speed = _basics.get_pushpull_speed
+get_pushpull_speeds = _basics.get_pushpull_speeds
+start_telemetry_pump = _basics.start_telemetry_pump
+stop_telemetry_pump = _basics.stop_telemetry_pump
 
 dll_path = os.path.join(os.path.dirname(__file__),
                         'c_lib' + get_ext_suffix())
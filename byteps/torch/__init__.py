@@ -26,6 +26,9 @@ from byteps.torch.ops import push_pull
 from byteps.torch.ops import poll, synchronize, declare
 from byteps.torch.ops import init, shutdown, suspend, resume
 from byteps.torch.ops import size, local_size, rank, local_rank
+from byteps.torch.ops import get_pushpull_speed, get_pushpull_speeds, NO_PUSHPULL_SPEED
+from byteps.torch.ops import start_telemetry_pump, stop_telemetry_pump
+from byteps.torch.ops import aggregate_pushpull_speeds
 
 import os
 import torch
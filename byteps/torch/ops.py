@@ -28,6 +28,7 @@ import torch
 # TODO: we may not support older pytorch. Raise exception here
 from byteps.torch import c_lib
 from byteps.common import BytePSBasics as _BytePSBasics
+from byteps.common import NO_PUSHPULL_SPEED, aggregate_pushpull_speeds
 _basics = _BytePSBasics(__file__, 'c_lib')
 _NULL = ""
 
@@ -43,6 +44,10 @@ size = _basics.size
 local_size = _basics.local_size
 rank = _basics.rank
 local_rank = _basics.local_rank
+get_pushpull_speed = _basics.get_pushpull_speed
+get_pushpull_speeds = _basics.get_pushpull_speeds
+start_telemetry_pump = _basics.start_telemetry_pump
+stop_telemetry_pump = _basics.stop_telemetry_pump
 
 
 # Schema: handle -> input, output
@@ -66,21 +71,32 @@ def _push_pull_function_factory(tensor):
 def _push_pull_group_function_factory(tensor):
     return 'byteps_torch_push_pull_group_sync_' + tensor.type().replace('.', '_')
 
+# Tensor names repeat every iteration, so encode each of them only once.
+_encoded_names = {}
+
+def _encode_name(name):
+    if name is None:
+        return _NULL
+    encoded = _encoded_names.get(name)
+    if encoded is None:
+        encoded = _encoded_names[name] = name.encode()
+    return encoded
+
 def _do_push_pull_async(tensor, output, average, name, version=0, priority=0):
-    c_lib.byteps_torch_declare_tensor(name.encode() if name is not None else _NULL)
+    name = _encode_name(name)
+    c_lib.byteps_torch_declare_tensor(name)
     function = _check_function(_push_pull_function_factory, tensor)
-    handle = getattr(c_lib, function)(tensor, output, average,
-                                      name.encode() if name is not None else _NULL,
+    handle = getattr(c_lib, function)(tensor, output, average, name,
                                       version, priority)
     _handle_map[handle] = (tensor, output)
     return handle
 
 def _do_push_pull_group_sync(tensor, output, average, name, version=0, priority=0):
-    c_lib.byteps_torch_declare_tensor(name.encode() if name is not None else _NULL)
+    name = _encode_name(name)
+    c_lib.byteps_torch_declare_tensor(name)
     function = _check_function(_push_pull_group_function_factory, tensor)
-    handle, curr_count = getattr(c_lib, function)(tensor, output, average,
-                                      name.encode() if name is not None else _NULL,
-                                      version, priority)
+    handle, curr_count = getattr(c_lib, function)(tensor, output, average, name,
+                                                  version, priority)
     _handle_map[handle] = (tensor, output)
     return handle, curr_count
 
@@ -1,76 +1,125 @@
 #!/usr/bin/python
 
 from __future__ import print_function
+import ctypes
+import ctypes.util
 import os
 import re
 import subprocess
-import threading
 import sys
 import time
-from functools import reduce
-
-
-class PropagatingThread(threading.Thread):
-    """ propagate exceptions to the parent's thread
-    refer to https://stackoverflow.com/a/31614591/9601110
-    """
-    def __init__(self, callback=None, idx=-1, **kwargs):
-        super().__init__(**kwargs)
-        self.callback = callback
-        self.idx = idx
-
-    def run(self):
-        self.exc = None
-        try:
-            if hasattr(self, '_Thread__target'):
-                #  python 2.x
-                self.ret = self._Thread__target(
-                    *self._Thread__args, **self._Thread__kwargs)
-            else:
-                # python 3.x
-                self.ret = self._target(*self._args, **self._kwargs)
-        except BaseException as e:
-            self.exc = e
-        if self.callback is not None:
-            self.callback(self.idx)
-
-    def join(self):
-        super(PropagatingThread, self).join()
-        if self.exc:
-            raise self.exc
-        return self.exc
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 
 
 COMMON_REQUIRED_ENVS = ["DMLC_ROLE", "DMLC_NUM_WORKER", "DMLC_NUM_SERVER",
                         "DMLC_PS_ROOT_URI", "DMLC_PS_ROOT_PORT"]
 WORKER_REQUIRED_ENVS = ["DMLC_WORKER_ID"]
 NUMA_PATH = "/sys/devices/system/node"
+NVIDIA_GPUS_PATH = "/proc/driver/nvidia/gpus"
+PCI_DEVICES_PATH = "/sys/bus/pci/devices"
+
+def read_nvidia_gpus():
+    """
+    returns the GPUs the nvidia driver exposes to this process, in PCI bus id
+    order, as (pci bus id, model, uuid) tuples.
+    """
+    gpus = []
+    try:
+        for bus_id in sorted(os.listdir(NVIDIA_GPUS_PATH), key=str.lower):
+            with open(os.path.join(NVIDIA_GPUS_PATH, bus_id, "information")) as f:
+                info = dict(line.split(":", 1) for line in f if ":" in line)
+            gpus.append((bus_id.lower(), info.get("Model", "").strip(),
+                         info.get("GPU UUID", "").strip()))
+    except OSError:
+        return []
+    return gpus
+
+
+def get_gpu_bus_id(local_rank, gpus):
+    """
+    returns the pci bus id of the GPU used by local_rank, or None if it cannot
+    be told. BytePS uses the local_rank-th CUDA device, i.e. the
+    local_rank-th entry of CUDA_VISIBLE_DEVICES when it is set.
+    """
+    devices = os.getenv("CUDA_VISIBLE_DEVICES")
+    if devices is None:
+        device = str(local_rank)
+    else:
+        devices = devices.split(",")
+        if local_rank >= len(devices):
+            return None
+        device = devices[local_rank].strip()
+    if device.startswith("GPU-"):
+        for bus_id, _, uuid in gpus:
+            if uuid == device:
+                return bus_id
+        return None
+    # other entries, e.g. MIG devices, cannot be matched
+    if not device.isdigit() or int(device) >= len(gpus):
+        return None
+    # CUDA numbers the devices fastest first unless CUDA_DEVICE_ORDER is
+    # PCI_BUS_ID. Identical GPUs are numbered in pci bus id order either way
+    if os.getenv("CUDA_DEVICE_ORDER") != "PCI_BUS_ID" and \
+            len(set(model for _, model, _ in gpus)) > 1:
+        return None
+    return gpus[int(device)][0]
+
+
+def get_gpu_numa_node(local_rank):
+    """
+    returns the numa node of the GPU used by local_rank, or None if it cannot
+    be found.
+    """
+    bus_id = get_gpu_bus_id(local_rank, read_nvidia_gpus())
+    if bus_id is None:
+        return None
+    try:
+        with open(os.path.join(PCI_DEVICES_PATH, bus_id, "numa_node")) as f:
+            node = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return node if node >= 0 else None
+
+
+CPU_RE = re.compile(r"cpu(\d+)$")
+NODE_RE = re.compile(r"node(\d+)$")
+
+@lru_cache(maxsize=None)
+def _read_numa_info(cpu_mt):
+    ret = []
+    if os.path.exists(NUMA_PATH):
+        items = os.listdir(NUMA_PATH)
+        # listdir order is arbitrary, keep the nodes in numa node order
+        nodes = sorted((item for item in items if NODE_RE.match(item)),
+                       key=lambda item: int(NODE_RE.match(item).group(1)))
+        if nodes:
+            for node in nodes:
+                cpu_ids = []
+                for item in os.listdir(os.path.join(NUMA_PATH, node)):
+                    match = CPU_RE.match(item)
+                    if match:
+                        cpu_ids.append(int(match.group(1)))
+                cpu_ids.sort()
+                if cpu_mt:
+                    cpu_ids = cpu_ids[:len(cpu_ids) // 2]
+                ret.append(tuple(cpu_ids))
+    else:
+        print("NUMA PATH %s NOT FOUND" % NUMA_PATH)
+    return tuple(ret)
+
+def get_numa_info(cpu_mt):
+    """
+    returns a list of list, each sub list is the cpu ids of a numa node. e.g
+    [[0,1,2,3], [4,5,6,7]]
+    The topology is read once; every call returns fresh lists that the caller
+    may modify.
+    """
+    return [list(node) for node in _read_numa_info(cpu_mt)]
 
 def allocate_cpu(local_size):
     cpu_mt = os.getenv("BYTEPS_MULTITHREADED_CPU", "1").lower() in ["1", "true"]
-    def get_numa_info():
-        """
-        returns a list of list, each sub list is the cpu ids of a numa node. e.g
-        [[0,1,2,3], [4,5,6,7]]
-        """
-        ret = []
-        if os.path.exists(NUMA_PATH):
-            items = os.listdir(NUMA_PATH)
-            nodes = list(filter(lambda str: str.startswith("node"), items))
-            if nodes:
-                for node in nodes:
-                    items = os.listdir(os.path.join(NUMA_PATH, node))
-                    cpus = [re.findall("cpu\d+", cpu) for cpu in items]
-                    cpus = list(filter(lambda x: x, cpus))
-                    cpu_ids = [int(cpu[0].split('cpu')[1]) for cpu in cpus]
-                    cpu_ids = sorted(cpu_ids)
-                    if cpu_mt:
-                        cpu_ids = cpu_ids[:len(cpu_ids) // 2]
-                    ret.append(cpu_ids)
-        else:
-            print("NUMA PATH %s NOT FOUND" % NUMA_PATH)
-        return ret
-
     def _get_allocation(nodes, quota, cpu_num, cpu_blacklist):
         if quota < 1:
             raise ValueError("quota should be no less than 1")
@@ -78,10 +127,9 @@ def allocate_cpu(local_size):
         for node in nodes:
             if len(node) < quota:
                 continue
-            split_index = []
-            for i in range(1, quota):
-                if node[i] != node[i-1] + 1:
-                    split_index.append(i)
+            # positions within the quota where the cpu ids stop being contiguous
+            split_index = [i for i, (prev, curr) in enumerate(zip(node, node[1:quota]), 1)
+                           if curr != prev + 1]
             quota_bck = quota
             last_idx = 0
             for idx in split_index:
@@ -92,11 +140,9 @@ def allocate_cpu(local_size):
             curr_alloc = [item for item in curr_alloc if item not in cpu_blacklist]
             ret.append(curr_alloc)
             if cpu_mt:
-                curr_alloc = [x + cpu_num for x in curr_alloc]
-                curr_alloc = [item for item in curr_alloc if item not in cpu_blacklist]
-                ret.append(curr_alloc)
-            for idx in sorted(range(quota_bck), reverse=True):
-                del node[idx]
+                ret.append([x + cpu_num for x in curr_alloc
+                            if x + cpu_num not in cpu_blacklist])
+            del node[:quota_bck]
             return ret
         return ret
 
@@ -121,26 +167,82 @@ def allocate_cpu(local_size):
             root_quota -= 1
         return [default_quota] * (local_size - 1) + [root_quota]
 
-    nodes = get_numa_info()
+    nodes = get_numa_info(cpu_mt)
     if not nodes:
         return None
-    cpu_num = reduce(lambda x, y: (x + len(y)), nodes, 0)
+    cpu_num = sum(map(len, nodes))
     quota_list = _get_quota(nodes, local_size)
     cpu_blacklist = os.getenv("BYTEPS_CPU_BLACKLIST", "-1")
-    cpu_blacklist = [int(item) for item in cpu_blacklist.split(",")]
+    cpu_blacklist = frozenset(int(item) for item in cpu_blacklist.split(","))
     ret = []
     for quota in quota_list:
-        while quota > 0:
-            allocation = _get_allocation(nodes, quota, cpu_num, cpu_blacklist)
-            if allocation:
-                ret.append(allocation)
-                break
-            else:
-                quota -= 1
+        # a quota is served by the first node with enough cpus left; if there
+        # is none, it shrinks to the largest node left
+        quota = min(quota, max(map(len, nodes)))
+        if quota > 0:
+            ret.append(_get_allocation(nodes, quota, cpu_num, cpu_blacklist))
 
     return ret
 
 
+def run_command(command, env):
+    subprocess.check_call(command, env=env,
+                          stdout=sys.stdout, stderr=sys.stderr, shell=True)
+
+
+def exec_command(command, env):
+    """
+    replaces the launcher process with command, for when the launcher has
+    nothing left to do but wait for it.
+    """
+    args = ["/bin/sh", "-c", command]
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvpe(args[0], args, env)
+
+
+@lru_cache(maxsize=None)
+def load_libnuma():
+    """
+    returns libnuma loaded with ctypes, or None if it is not available.
+    """
+    try:
+        lib = ctypes.CDLL(ctypes.util.find_library("numa") or "libnuma.so.1")
+    except OSError:
+        return None
+    if lib.numa_available() < 0:
+        return None
+    lib.numa_parse_nodestring.restype = ctypes.c_void_p
+    lib.numa_parse_nodestring.argtypes = [ctypes.c_char_p]
+    lib.numa_set_membind.argtypes = [ctypes.c_void_p]
+    lib.numa_set_preferred.argtypes = [ctypes.c_int]
+    return lib
+
+
+def bind_numa(cpus, mem_node=None):
+    """
+    pins the calling thread to cpus and, when mem_node is given and libnuma
+    is available, allocates its memory on that numa node. Both settings are
+    per thread and inherited by the processes it starts, so the worker calls
+    it from the thread that runs the command.
+    """
+    os.sched_setaffinity(0, cpus)
+    if mem_node is None:
+        return
+    libnuma = load_libnuma()
+    if libnuma is None:
+        print("Warning: libnuma not found, memory is not bound to numa node %d. "
+              "try `sudo apt-get install libnuma1`." % mem_node)
+        return
+    nodemask = None
+    if int(os.getenv("BYTEPS_GPU_NUMA_MEMBIND", 0)):
+        nodemask = libnuma.numa_parse_nodestring(str(mem_node).encode())
+    if nodemask:
+        libnuma.numa_set_membind(nodemask)
+    else:
+        libnuma.numa_set_preferred(mem_node)
+
+
 def check_env():
     assert "DMLC_ROLE" in os.environ and \
            os.environ["DMLC_ROLE"].lower() in ["worker", "server", "scheduler"]
@@ -158,10 +260,23 @@ def check_env():
             os._exit(0)
 
 
-def worker(local_rank, local_size, command, allocation=None):
-    my_env = os.environ.copy()
-    my_env["BYTEPS_LOCAL_RANK"] = str(local_rank)
-    my_env["BYTEPS_LOCAL_SIZE"] = str(local_size)
+def default_partition_bytes(env):
+    """
+    returns the BYTEPS_PARTITION_BYTES to use when it is not set: large
+    partitions pay off on RDMA, while over TCP smaller ones pipeline better.
+    """
+    for transport in ("DMLC_ENABLE_RDMA", "DMLC_ENABLE_UCX"):
+        if env.get(transport, "0") not in ("", "0"):
+            return "4096000"
+    return "1024000"
+
+
+def worker(local_rank, local_size, command, allocation=None, replace_process=False,
+           base_env=None):
+    # base_env is the environment shared by all the local ranks, built once
+    my_env = dict(os.environ if base_env is None else base_env,
+                  BYTEPS_LOCAL_RANK=str(local_rank),
+                  BYTEPS_LOCAL_SIZE=str(local_size))
     if int(os.getenv("BYTEPS_ENABLE_GDB", 0)):
         if command.find("python") != 0:
             command = "python " + command
@@ -169,80 +284,73 @@ def worker(local_rank, local_size, command, allocation=None):
 
     if allocation:
         print("enable NUMA finetune...")
-        retval = subprocess.call(
-            ["dpkg", "-s", "numactl"], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-        if retval == 0:
-            numa = "numactl --physcpubind "
-            for cpu_set in allocation:
-                if len(cpu_set) == 1:
-                    numa += "{},".format(cpu_set[0])
-                else:
-                    numa += "{}-{},".format(cpu_set[0], cpu_set[-1])
-            numa = numa.strip(',') + ' '
-            command = numa + command
-            print("Command: %s\n" % command)
-        else:
-            print("Warning: numactl not found. try `sudo apt-get install numactl`.")
+        cpus = frozenset(cpu for cpu_set in allocation for cpu in cpu_set)
+        # keep the memory on the numa node of the GPU, so that host/device
+        # copies do not cross sockets
+        bind_numa(cpus, get_gpu_numa_node(local_rank))
+        print("CPU affinity of local rank %d: %s\n" % (local_rank, sorted(cpus)))
 
     if os.environ.get("BYTEPS_TRACE_ON", "") == "1":
-        print("\n!!!Enable profiling for WORKER_ID: %s and local_rank: %d!!!" %
-              (os.environ.get("DMLC_WORKER_ID"), local_rank))
-        print("BYTEPS_TRACE_START_STEP: %s\tBYTEPS_TRACE_END_STEP: %s\t BYTEPS_TRACE_DIR: %s" % (os.environ.get(
-            "BYTEPS_TRACE_START_STEP", ""), os.environ.get("BYTEPS_TRACE_END_STEP", ""), os.environ.get("BYTEPS_TRACE_DIR", "")))
-        print("Command: %s\n" % command)
-        sys.stdout.flush()
+        # one write, so that the messages of concurrent ranks do not interleave
+        sys.stdout.write(
+            "\n!!!Enable profiling for WORKER_ID: %s and local_rank: %d!!!\n"
+            "BYTEPS_TRACE_START_STEP: %s\tBYTEPS_TRACE_END_STEP: %s\t BYTEPS_TRACE_DIR: %s\n"
+            "Command: %s\n\n" %
+            (os.environ.get("DMLC_WORKER_ID"), local_rank,
+             os.environ.get("BYTEPS_TRACE_START_STEP", ""),
+             os.environ.get("BYTEPS_TRACE_END_STEP", ""),
+             os.environ.get("BYTEPS_TRACE_DIR", ""), command))
         trace_path = os.path.join(os.environ.get(
             "BYTEPS_TRACE_DIR", "."), str(local_rank))
-        if not os.path.exists(trace_path):
-            os.makedirs(trace_path)
-    subprocess.check_call(command, env=my_env,
-                          stdout=sys.stdout, stderr=sys.stderr, shell=True)
+        os.makedirs(trace_path, exist_ok=True)
+    if replace_process:
+        exec_command(command, my_env)
+    else:
+        run_command(command, my_env)
 
 def parse_num_range(core_list):
     # core_list is a colon-seperated string. each section is the physical
     # core assignment for the corresponding byteps worker.
     # example input: 1,4-5,7-11,12:20-25
     # example output: [[[1], [4, 5], [7, 8, 9, 10, 11], [12]], [[20, 21, 22, 23, 24, 25]]]
-    core_list = core_list.split(':')
     ret = []
-    for item in core_list:
-        temp = [(lambda sub: range(sub[0], sub[-1] + 1))(list(map(int, elem.split('-')))) for elem in item.split(',')]
-        ret.append([list(a) for a in temp])
+    for item in core_list.split(':'):
+        section = []
+        for elem in item.split(','):
+            first, _, last = elem.partition('-')
+            section.append(list(range(int(first), int(last or first) + 1)))
+        ret.append(section)
     return ret
 
-cv = threading.Condition(lock=threading.Lock())
-done_threads = []
-
-def done_callback(idx):
-    with cv:
-        done_threads.append(idx)
-        cv.notify()
-
-def join_threads(threads):
-    count = 0
-    num = len(threads)
-    while count < num:
-        with cv:
-            while not done_threads:
-                cv.wait()
-            idx = done_threads[-1]
-            done_threads.pop()
-        threads[idx].join()
-        print("BytePS launcher: joined local rank ", idx)
-        count += 1
-
 def launch_bps():
+    # every line reaches the output as soon as it is printed, interleaved
+    # correctly with the output of the child processes
+    if hasattr(sys.stdout, "reconfigure"):
+        sys.stdout.reconfigure(line_buffering=True)
     print("BytePS launching " + os.environ["DMLC_ROLE"])
-    sys.stdout.flush()
     check_env()
     os.environ["PYTHONUNBUFFERED"] = "1"
     os.environ["UCX_HANDLE_ERRORS"] = os.getenv("UCX_HANDLE_ERRORS", "none")
+    base_env = dict(os.environ)
+    # let UCX split large rendezvous messages across NICs, unless the user
+    # configured it already. This is set for every role, so that both ends of
+    # a connection agree
+    base_env.setdefault("UCX_MAX_RNDV_RAILS", os.getenv("BYTEPS_UCX_MAX_RNDV_RAILS", "4"))
+    base_env.setdefault("UCX_RNDV_SCHEME", "auto")
     if os.environ["DMLC_ROLE"] == "worker":
         if "NVIDIA_VISIBLE_DEVICES" in os.environ:
             local_size = len(os.environ["NVIDIA_VISIBLE_DEVICES"].split(","))
         else:
             local_size = 1
-        t = [None] * local_size
+        if "BYTEPS_PARTITION_BYTES" not in base_env:
+            base_env["BYTEPS_PARTITION_BYTES"] = default_partition_bytes(base_env)
+        # GPU buffers benefit from switching to zero-copy rendezvous early.
+        # Servers cannot tell whether the workers use GPUs, so they keep the
+        # UCX defaults
+        if os.getenv("NVIDIA_VISIBLE_DEVICES") or os.getenv("CUDA_VISIBLE_DEVICES") \
+                or os.path.exists("/dev/nvidia0"):
+            base_env.setdefault("UCX_RNDV_THRESH", "4k")
+            base_env.setdefault("UCX_MEMTYPE_CACHE", "n")
 
         bind_to_cores = os.getenv("BYTEPS_NUMA_ON", "1") == "1"
         if bind_to_cores:
@@ -252,29 +360,42 @@ def launch_bps():
             else:
                 allocations = allocate_cpu(local_size)
 
+        command = ' '.join(sys.argv[1:])
+        if local_size == 1:
+            # a single local rank replaces the launcher instead of running
+            # in a child process of it
+            allocation = allocations[0] if bind_to_cores else None
+            worker(0, local_size, command, allocation, replace_process=True,
+                   base_env=base_env)
+
+        # one thread per local rank, to wait for its process
+        executor = ThreadPoolExecutor(max_workers=local_size)
+        futures = {}
         for i in range(local_size):
-            command = ' '.join(sys.argv[1:])
-            if bind_to_cores:
-                t[i] = PropagatingThread(idx=i, callback=done_callback,
-                    target=worker,
-                    args=[i, local_size, command, allocations[i]])
-            else:
-                t[i] = PropagatingThread(idx=i, callback=done_callback,
-                    target=worker, args=[i, local_size, command])
-            t[i].daemon = True
-            t[i].start()
-
-        join_threads(t)
+            allocation = allocations[i] if bind_to_cores else None
+            future = executor.submit(worker, i, local_size, command, allocation,
+                                     base_env=base_env)
+            futures[future] = i
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except BaseException:
+                traceback.print_exc()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                # the other local ranks cannot finish without this one, so do
+                # not wait for their threads on the way out
+                os._exit(1)
+            print("BytePS launcher: joined local rank ", futures[future])
+        executor.shutdown()
 
     elif os.environ.get("BYTEPS_FORCE_DISTRIBUTED", "") == "1" or \
          int(os.environ.get("DMLC_NUM_WORKER", "1")) > 1:
         command = "python3 -c 'import byteps.server'"
         if int(os.getenv("BYTEPS_ENABLE_GDB", 0)):
             command = "gdb -ex 'run' -ex 'bt' -batch --args " + command
-        print("Command: %s\n" % command, flush=True)
-        my_env = os.environ.copy()
-        subprocess.check_call(command, env=my_env,
-                              stdout=sys.stdout, stderr=sys.stderr, shell=True)
+        print("Command: %s\n" % command)
+        exec_command(command, base_env)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,221 @@
+# Copyright 2020 Bytedance Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for the push pull speed telemetry of byteps.common. The C library is
+replaced by a fake speed queue, so no BytePS build is needed."""
+
+import ctypes
+import os
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from byteps.common import BytePSBasics, NO_PUSHPULL_SPEED, PushPullSpeedView
+from byteps.common import aggregate_pushpull_speeds
+
+
+class FakeSpeedQueue(object):
+    """Stands in for PushPullSpeed in byteps/common/global.cc."""
+
+    def __init__(self, entries=()):
+        self.entries = list(entries)
+        self.calls = []
+
+    def pop(self):
+        # byteps_get_pushpull_speed
+        if not self.entries:
+            return NO_PUSHPULL_SPEED
+        return self.entries.pop(0)
+
+    def snapshot(self, ts, speed, max_size, actual, remaining):
+        # byteps_get_pushpull_speed_snapshot
+        self.calls.append(max_size)
+        n = min(max_size, len(self.entries))
+        for i in range(n):
+            ts[i], speed[i] = self.entries[i]
+        del self.entries[:n]
+        actual[0] = n
+        remaining[0] = len(self.entries)
+
+
+class TelemetryTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch.object(ctypes, 'CDLL'), \
+                mock.patch.dict(os.environ, {'BYTEPS_TELEMETRY_CAP': '4'}):
+            self.basics = BytePSBasics(__file__, 'c_lib')
+        self.queue = FakeSpeedQueue()
+        self.basics._c_get_speed = self.queue.pop
+        self.basics._c_get_speed_snapshot = self.queue.snapshot
+        self.addCleanup(self.basics.stop_telemetry_pump)
+
+    def _wait_for_pump(self, count):
+        # until the pump has moved count entries out of the library
+        deadline = time.time() + 10
+        while len(self.basics._speed_queue) < count:
+            self.assertLess(time.time(), deadline, 'the pump did not drain the queue')
+            time.sleep(0.01)
+
+    def test_get_pushpull_speeds(self):
+        self.queue.entries = [(1000 + i, float(i)) for i in range(3)]
+        speeds = self.basics.get_pushpull_speeds()
+        self.assertEqual(list(speeds), [(1000, 0.), (1001, 1.), (1002, 2.)])
+        self.assertEqual(self.queue.calls, [4])
+        self.assertEqual(len(self.basics.get_pushpull_speeds()), 0)
+
+    def test_get_pushpull_speeds_grows_buffers(self):
+        entries = [(1000 + i, i / 4.) for i in range(10)]
+        self.queue.entries = list(entries)
+        speeds = self.basics.get_pushpull_speeds()
+        # the first fetch fills the 4 entry buffers, the second one the rest
+        self.assertEqual(self.queue.calls, [4, 6])
+        self.assertEqual(list(speeds), entries)
+        for ts, speed in speeds:
+            self.assertIsInstance(ts, int)
+            self.assertIsInstance(speed, float)
+        self.assertEqual(self.basics._tele_cap, 10)
+
+        # the grown buffers are reused, and the entries are copied out of them
+        self.queue.entries = [(2000, 8.)]
+        self.assertEqual(list(self.basics.get_pushpull_speeds()), [(2000, 8.)])
+        self.assertEqual(self.queue.calls[-1], 10)
+        self.assertEqual(list(speeds), entries)
+
+    def test_get_pushpull_speeds_as_arrays(self):
+        self.queue.entries = [(1000 + i, i / 4.) for i in range(10)]
+        arrays = self.basics.get_pushpull_speeds(as_arrays=True)
+        self.assertEqual(arrays['ts'].dtype, np.uint64)
+        self.assertEqual(arrays['speed'].dtype, np.float32)
+        self.assertEqual(arrays['ts'].tolist(), list(range(1000, 1010)))
+        self.assertEqual(arrays['speed'].tolist(), [i / 4. for i in range(10)])
+
+    def test_get_pushpull_speeds_size(self):
+        self.queue.entries = [(1000 + i, float(i)) for i in range(10)]
+        speeds = self.basics.get_pushpull_speeds(size=6)
+        # an explicit size is a limit, the rest stays queued
+        self.assertEqual(list(speeds), [(1000 + i, float(i)) for i in range(6)])
+        self.assertEqual(len(self.queue.entries), 4)
+
+    def test_telemetry_pump(self):
+        self.queue.entries = [(1000 + i, float(i)) for i in range(6)]
+        self.basics.start_telemetry_pump(interval_s=0.01)
+        self._wait_for_pump(6)
+        self.assertEqual(self.basics.get_pushpull_speed(), (1000, 0.))
+        self.assertEqual(list(self.basics.get_pushpull_speeds(size=2)),
+                         [(1001, 1.), (1002, 2.)])
+        self.basics.stop_telemetry_pump()
+
+        # what the pump collected is not lost, and comes before the entries
+        # queued in the library after it stopped
+        self.queue.entries = [(2000, 7.), (2001, 8.)]
+        self.assertEqual(self.basics.get_pushpull_speed(), (1003, 3.))
+        self.assertEqual(list(self.basics.get_pushpull_speeds()),
+                         [(1004, 4.), (1005, 5.), (2000, 7.), (2001, 8.)])
+        self.assertEqual(self.basics.get_pushpull_speed(), NO_PUSHPULL_SPEED)
+
+    def test_telemetry_pump_restart(self):
+        self.queue.entries = [(1000, 0.), (1001, 1.)]
+        self.basics.start_telemetry_pump(interval_s=0.01)
+        self._wait_for_pump(2)
+        self.basics.stop_telemetry_pump()
+        self.queue.entries = [(2000, 7.)]
+        self.basics.start_telemetry_pump(interval_s=0.01)
+        self._wait_for_pump(3)
+        self.assertEqual(list(self.basics.get_pushpull_speeds()),
+                         [(1000, 0.), (1001, 1.), (2000, 7.)])
+        # the pump does not call into the library for get_pushpull_speed()
+        self.assertEqual(self.basics.get_pushpull_speed(), NO_PUSHPULL_SPEED)
+
+
+class PushPullSpeedViewTestCase(unittest.TestCase):
+    def setUp(self):
+        self.entries = [(1000, 0.5), (1001, 1.5), (1002, 2.5), (1003, 3.5)]
+        # the buffers are larger than the view, like the telemetry buffers
+        ts = (ctypes.c_uint64 * 6)(*[ts for ts, _ in self.entries])
+        speed = (ctypes.c_float * 6)(*[speed for _, speed in self.entries])
+        self.view = PushPullSpeedView(ts, speed, len(self.entries))
+
+    def test_sequence(self):
+        self.assertEqual(len(self.view), 4)
+        self.assertEqual(self.view[0], (1000, 0.5))
+        self.assertEqual(self.view[-1], (1003, 3.5))
+        self.assertEqual(list(self.view), self.entries)
+        self.assertEqual(list(reversed(self.view)), self.entries[::-1])
+        self.assertIn((1002, 2.5), self.view)
+        for i in (4, -5):
+            with self.assertRaises(IndexError):
+                self.view[i]
+
+    def test_slice(self):
+        self.assertEqual(self.view[1:3], self.entries[1:3])
+        self.assertEqual(self.view[::-2], self.entries[::-2])
+        self.assertEqual(self.view[3:10], self.entries[3:])
+        self.assertEqual(self.view[5:], [])
+
+    def test_as_arrays(self):
+        arrays = self.view.as_arrays()
+        self.assertEqual(arrays['ts'].dtype, np.uint64)
+        self.assertEqual(arrays['speed'].dtype, np.float32)
+        self.assertEqual(arrays['ts'].tolist(), [ts for ts, _ in self.entries])
+        self.assertEqual(arrays['speed'].tolist(), [speed for _, speed in self.entries])
+
+    def test_empty(self):
+        view = PushPullSpeedView((ctypes.c_uint64 * 0)(), (ctypes.c_float * 0)(), 0)
+        self.assertEqual(len(view), 0)
+        self.assertEqual(list(view), [])
+        self.assertEqual(view.as_arrays()['ts'].size, 0)
+
+
+def _snapshot(entries):
+    return {'ts': np.array([ts for ts, _ in entries], dtype=np.uint64),
+            'speed': np.array([speed for _, speed in entries], dtype=np.float32)}
+
+
+class AggregatePushPullSpeedsTestCase(unittest.TestCase):
+    def _check(self, result, ts, count, total):
+        self.assertEqual(result['ts'].dtype, np.uint64)
+        self.assertEqual(result['ts'].tolist(), ts)
+        self.assertEqual(result['count'].tolist(), count)
+        np.testing.assert_allclose(result['total'], total)
+        np.testing.assert_allclose(result['mean'], np.divide(total, count))
+
+    def test_windows(self):
+        worker0 = _snapshot([(10000, 1.), (19999, 2.), (20000, 4.)])
+        worker1 = _snapshot([(25000, 8.), (9999, 16.), (10500, 32.)])
+        result = aggregate_pushpull_speeds([worker0, worker1])
+        # windows start at multiples of window_ms, and are sorted by time
+        self._check(result, [0, 10000, 20000], [1, 3, 2], [16., 35., 12.])
+
+    def test_window_ms(self):
+        result = aggregate_pushpull_speeds(
+            [_snapshot([(999, 1.), (1000, 2.), (1999, 4.), (5000, 8.)])],
+            window_ms=1000)
+        self._check(result, [0, 1000, 5000], [1, 2, 1], [1., 6., 8.])
+
+    def test_single_sample(self):
+        result = aggregate_pushpull_speeds([_snapshot([(12345, 3.5)])])
+        self._check(result, [10000], [1], [3.5])
+
+    def test_empty(self):
+        for snapshots in ([], [_snapshot([])], [_snapshot([]), _snapshot([])]):
+            result = aggregate_pushpull_speeds(snapshots)
+            self.assertEqual(sorted(result), ['count', 'mean', 'total', 'ts'])
+            for values in result.values():
+                self.assertEqual(values.size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
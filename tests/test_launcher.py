@@ -0,0 +1,176 @@
+# Copyright 2020 Bytedance Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for the cpu allocation and GPU numa node lookup of
+launcher/launch.py, on a fake numa topology and nvidia driver."""
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+LAUNCH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, "launcher", "launch.py")
+_spec = importlib.util.spec_from_file_location("launch", LAUNCH_PATH)
+launch = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(launch)
+
+# two sockets of 4 cores, with hyper-threading: cpu i and i + 8 are siblings
+TOPOLOGY = [list(range(0, 4)) + list(range(8, 12)),
+            list(range(4, 8)) + list(range(12, 16))]
+
+
+class AllocateCpuTestCase(unittest.TestCase):
+    def setUp(self):
+        numa_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, numa_path)
+        for node, cpus in enumerate(TOPOLOGY):
+            for cpu in cpus:
+                os.makedirs(os.path.join(numa_path, "node%d" % node, "cpu%d" % cpu))
+            # not a cpu, like the other entries of a sysfs node
+            os.makedirs(os.path.join(numa_path, "node%d" % node, "cpulist"))
+        os.makedirs(os.path.join(numa_path, "has_cpu"))
+
+        patcher = mock.patch.object(launch, "NUMA_PATH", numa_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        env_patcher = mock.patch.dict(os.environ)
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+        for name in ("BYTEPS_MULTITHREADED_CPU", "BYTEPS_CPU_BLACKLIST",
+                     "BYTEPS_NUMA_DEFAULT_QUOTA", "BYTEPS_NUMA_ROOT_QUOTA"):
+            os.environ.pop(name, None)
+        launch._read_numa_info.cache_clear()
+        self.addCleanup(launch._read_numa_info.cache_clear)
+
+    def test_get_numa_info(self):
+        self.assertEqual(launch.get_numa_info(False), TOPOLOGY)
+        self.assertEqual(launch.get_numa_info(True), [[0, 1, 2, 3], [4, 5, 6, 7]])
+        # callers may modify the lists they get
+        launch.get_numa_info(False)[0].clear()
+        self.assertEqual(launch.get_numa_info(False), TOPOLOGY)
+
+    def test_allocate_cpu(self):
+        self.assertEqual(launch.allocate_cpu(1), [[[0, 1], [8, 9]]])
+        self.assertEqual(launch.allocate_cpu(2),
+                         [[[0, 1, 2, 3], [8, 9, 10, 11]], [[4, 5], [12, 13]]])
+        self.assertEqual(launch.allocate_cpu(4),
+                         [[[0, 1], [8, 9]], [[2, 3], [10, 11]],
+                          [[4, 5], [12, 13]], [[6, 7], [14, 15]]])
+
+    def test_allocate_cpu_blacklist(self):
+        os.environ["BYTEPS_CPU_BLACKLIST"] = "1,9"
+        self.assertEqual(launch.allocate_cpu(1), [[[0], [8]]])
+        self.assertEqual(launch.allocate_cpu(2),
+                         [[[0, 2, 3], [8, 10, 11]], [[4, 5], [12, 13]]])
+
+    def test_allocate_cpu_without_multithreading(self):
+        os.environ["BYTEPS_MULTITHREADED_CPU"] = "0"
+        self.assertEqual(launch.allocate_cpu(2),
+                         [[[0, 1, 2, 3], [8, 9, 10, 11]],
+                          [[4, 5, 6, 7], [12, 13, 14, 15]]])
+        self.assertEqual(launch.allocate_cpu(4),
+                         [[[0, 1, 2, 3]], [[8, 9, 10, 11]],
+                          [[4, 5, 6, 7]], [[12, 13, 14, 15]]])
+
+    def test_allocate_cpu_without_numa(self):
+        launch.NUMA_PATH = os.path.join(launch.NUMA_PATH, "missing")
+        self.assertIsNone(launch.allocate_cpu(2))
+
+
+# pci bus id, model, uuid and numa node of the fake GPUs, in creation order
+GPUS = [("0000:DA:00.0", "Tesla V100-SXM2-32GB", "GPU-dddd", 1),
+        ("0000:1A:00.0", "Tesla V100-SXM2-32GB", "GPU-aaaa", 0),
+        ("0000:B2:00.0", "Tesla V100-SXM2-32GB", "GPU-cccc", 1),
+        ("0000:3D:00.0", "Tesla V100-SXM2-32GB", "GPU-bbbb", -1)]
+
+
+class GpuNumaNodeTestCase(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.gpus_path = os.path.join(root, "gpus")
+        self.pci_path = os.path.join(root, "pci")
+        self._make_gpus(GPUS)
+        for name, value in (("NVIDIA_GPUS_PATH", self.gpus_path),
+                            ("PCI_DEVICES_PATH", self.pci_path)):
+            patcher = mock.patch.object(launch, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        env_patcher = mock.patch.dict(os.environ)
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+        for name in ("CUDA_VISIBLE_DEVICES", "CUDA_DEVICE_ORDER"):
+            os.environ.pop(name, None)
+
+    def _make_gpus(self, gpus):
+        for bus_id, model, uuid, node in gpus:
+            os.makedirs(os.path.join(self.gpus_path, bus_id))
+            with open(os.path.join(self.gpus_path, bus_id, "information"), "w") as f:
+                f.write("Model: \t\t %s\nIRQ:   \t\t 42\nGPU UUID: \t %s\n"
+                        "Bus Location: \t %s\nDevice Minor: \t %d\n"
+                        % (model, uuid, bus_id, len(os.listdir(self.gpus_path)) - 1))
+            os.makedirs(os.path.join(self.pci_path, bus_id.lower()))
+            with open(os.path.join(self.pci_path, bus_id.lower(), "numa_node"), "w") as f:
+                f.write("%d\n" % node)
+
+    def _numa_nodes(self, local_size=4):
+        return [launch.get_gpu_numa_node(i) for i in range(local_size)]
+
+    def test_pci_bus_order(self):
+        # CUDA devices are numbered in pci bus id order, not by device minor
+        self.assertEqual(self._numa_nodes(), [0, None, 1, 1])
+        self.assertIsNone(launch.get_gpu_numa_node(4))
+
+    def test_cuda_visible_devices(self):
+        os.environ["CUDA_VISIBLE_DEVICES"] = "2,0"
+        self.assertEqual(self._numa_nodes(3), [1, 0, None])
+
+    def test_uuid(self):
+        os.environ["CUDA_VISIBLE_DEVICES"] = "GPU-cccc,GPU-aaaa,GPU-ffff"
+        self.assertEqual(self._numa_nodes(3), [1, 0, None])
+
+    def test_unknown_devices(self):
+        os.environ["CUDA_VISIBLE_DEVICES"] = "MIG-GPU-aaaa/1/0,7"
+        self.assertEqual(self._numa_nodes(2), [None, None])
+
+    def test_mixed_models(self):
+        self._make_gpus([("0000:05:00.0", "Tesla T4", "GPU-eeee", 0)])
+        # fastest first numbering cannot be told apart from the driver
+        self.assertEqual(self._numa_nodes(5), [None] * 5)
+        os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+        self.assertEqual(self._numa_nodes(5), [0, 0, None, 1, 1])
+        # uuids do not depend on the order
+        del os.environ["CUDA_DEVICE_ORDER"]
+        os.environ["CUDA_VISIBLE_DEVICES"] = "GPU-dddd"
+        self.assertEqual(self._numa_nodes(1), [1])
+
+    def test_no_driver(self):
+        shutil.rmtree(self.gpus_path)
+        self.assertEqual(self._numa_nodes(), [None] * 4)
+
+
+class ParseNumRangeTestCase(unittest.TestCase):
+    def test_parse_num_range(self):
+        self.assertEqual(launch.parse_num_range("1,4-5,7-11,12:20-25"),
+                         [[[1], [4, 5], [7, 8, 9, 10, 11], [12]],
+                          [[20, 21, 22, 23, 24, 25]]])
+        self.assertEqual(launch.parse_num_range("3"), [[[3]]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,232 @@
+# Copyright 2020 Bytedance Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for the graph-side logic of byteps.tensorflow: gradient accumulation,
+gradient fusion and fused broadcast. push_pull and broadcast are stubbed, so
+no BytePS cluster is needed."""
+
+import os
+import unittest
+from unittest import mock
+
+import numpy as np
+import tensorflow as tf
+
+import byteps.tensorflow as bps
+
+v1 = tf.compat.v1
+
+SIZE = 4
+
+
+class TensorFlowTests(unittest.TestCase):
+    def setUp(self):
+        # every worker contributes the same tensor, so the sum is SIZE times it
+        self.push_pulls = []
+        self.broadcasts = []
+
+        def push_pull(tensor, scope='', name=None):
+            self.push_pulls.append(tensor)
+            # like the BytepsPushPull op, IndexedSlices come back dense
+            return tf.convert_to_tensor(tensor) * SIZE
+
+        def broadcast(tensor, root_rank, scope='', name=None, is_variable=True):
+            self.broadcasts.append(tensor)
+            # not the identity, so that a misplaced split shows up
+            return tensor * 2 + 1
+
+        for target, stub in (('_push_pull', push_pull), ('broadcast', broadcast),
+                             ('size', lambda: SIZE)):
+            patcher = mock.patch.object(bps, target, stub)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        bps._invalidate_size_cache()
+        self.addCleanup(bps._invalidate_size_cache)
+
+        graph = tf.Graph()
+        self.graph_context = graph.as_default()
+        self.graph_context.__enter__()
+        self.addCleanup(self.graph_context.__exit__, None, None, None)
+        self.sess = v1.Session(graph=graph)
+        self.addCleanup(self.sess.close)
+
+    def _check_accumulation(self, make_optimizer, steps=3):
+        x = v1.placeholder(tf.float32, [3])
+        w = v1.get_variable('w', initializer=tf.constant([1., 2., 3.]))
+        # not part of the loss, so its gradient is None
+        unused = v1.get_variable('unused', initializer=tf.constant([5.]))
+        opt = bps.DistributedOptimizer(make_optimizer(),
+                                       backward_passes_per_step=steps)
+        grads_and_vars = opt.compute_gradients(tf.reduce_sum(w * x),
+                                               var_list=[w, unused])
+        self.assertIsNone(grads_and_vars[1][0])
+        train_op = opt.apply_gradients(grads_and_vars)
+
+        # the same optimizer, applied once to the summed gradient
+        ref_w = v1.get_variable('ref_w', initializer=tf.constant([1., 2., 3.]))
+        ref_grad = v1.placeholder(tf.float32, [3])
+        ref_train_op = make_optimizer().apply_gradients([(ref_grad, ref_w)])
+
+        self.sess.run([v1.global_variables_initializer(),
+                       v1.local_variables_initializer()])
+        rng = np.random.RandomState(0)
+        for _ in range(2):
+            inputs = rng.rand(steps, 3).astype(np.float32)
+            before = self.sess.run(w)
+            for i in range(steps):
+                self.sess.run(train_op, feed_dict={x: inputs[i]})
+                if i < steps - 1:
+                    np.testing.assert_array_equal(self.sess.run(w), before)
+            self.sess.run(ref_train_op, feed_dict={ref_grad: inputs.sum(axis=0)})
+            np.testing.assert_allclose(self.sess.run(w), self.sess.run(ref_w),
+                                       rtol=1e-6)
+            self.assertEqual(self.sess.run(unused), [5.])
+
+    def test_backward_passes_per_step_sgd(self):
+        self._check_accumulation(lambda: v1.train.GradientDescentOptimizer(0.1))
+
+    def test_backward_passes_per_step_adam(self):
+        self._check_accumulation(lambda: v1.train.AdamOptimizer(0.1))
+
+    def test_backward_passes_per_step_var_list(self):
+        w = v1.get_variable('w', initializer=tf.constant([1., 2.]))
+        b = v1.get_variable('b', initializer=tf.constant([3.]))
+        loss = tf.reduce_sum(w * w) + tf.reduce_sum(b)
+        opt = bps.DistributedOptimizer(v1.train.GradientDescentOptimizer(0.1),
+                                       backward_passes_per_step=2)
+        opt.compute_gradients(loss, var_list=[w, b])
+        # the same variables again are fine, other ones would be paired with
+        # the wrong accumulators
+        opt.compute_gradients(loss, var_list=[w, b])
+        for var_list in ([w], [b, w]):
+            with self.assertRaises(ValueError):
+                opt.compute_gradients(loss, var_list=var_list)
+
+    def test_backward_passes_per_step_global_step(self):
+        global_step = v1.train.get_or_create_global_step()
+        w = v1.get_variable('w', initializer=tf.constant([1., 2.]))
+        opt = bps.DistributedOptimizer(v1.train.GradientDescentOptimizer(0.1),
+                                       backward_passes_per_step=3)
+        train_op = opt.minimize(tf.reduce_sum(w * w), global_step=global_step)
+        self.sess.run([v1.global_variables_initializer(),
+                       v1.local_variables_initializer()])
+        steps = []
+        for _ in range(6):
+            self.sess.run(train_op)
+            steps.append(self.sess.run(global_step))
+        self.assertEqual(steps, [0, 0, 1, 1, 1, 2])
+
+    def _grads(self):
+        return [
+            tf.constant(np.arange(6, dtype=np.float32).reshape(2, 3)),
+            None,
+            tf.constant([1, 2, 3], dtype=tf.int32),
+            tf.constant(np.arange(4, dtype=np.float16)),
+            tf.constant([7.5], dtype=tf.float32),
+            tf.IndexedSlices(tf.constant([[1., 2.]]), tf.constant([1]),
+                             tf.constant([3, 2])),
+            tf.constant(np.ones(1024, dtype=np.float32)),
+        ]
+
+    def _unfused(self, grads):
+        return [bps.push_pull(grad, 'test') if grad is not None else None
+                for grad in grads]
+
+    def _check_fusion(self, fused_grads, grads):
+        expected = self.sess.run([tf.convert_to_tensor(grad)
+                                  for grad in self._unfused(grads)
+                                  if grad is not None])
+        results = self.sess.run([tf.convert_to_tensor(grad)
+                                 for grad in fused_grads if grad is not None])
+        self.assertEqual([grad is None for grad in fused_grads],
+                         [grad is None for grad in grads])
+        for result, want in zip(results, expected):
+            self.assertEqual(result.dtype, want.dtype)
+            np.testing.assert_array_equal(result, want)
+
+    def test_group_push_pull_grads(self):
+        grads = self._grads()
+        fused_grads = bps._group_push_pull_grads(grads, 'test')
+        # one push_pull per dtype, plus one for the IndexedSlices
+        self.assertEqual(len(self.push_pulls), 4)
+        self._check_fusion(fused_grads, grads)
+
+    def test_group_push_pull_grads_threshold(self):
+        grads = self._grads()
+        # 1024 float32 elements are above the threshold, the rest below
+        with mock.patch.dict(os.environ, {'BYTEPS_FUSION_THRESHOLD_MB': '0.001'}):
+            fused_grads = bps._group_push_pull_grads(grads, 'test')
+        self.assertEqual(len(self.push_pulls), 5)
+        self._check_fusion(fused_grads, grads)
+
+    def test_group_push_pull_grads_nested(self):
+        grads = {'a': [tf.constant([1., 2.]), tf.constant([3.])],
+                 'b': tf.constant([4.])}
+        fused_grads = bps._group_push_pull_grads(grads, 'test')
+        self.assertEqual(len(self.push_pulls), 1)
+        results = self.sess.run(fused_grads)
+        self.assertEqual(sorted(results), ['a', 'b'])
+        self.assertEqual([result.tolist() for result in results['a']],
+                         [[1., 2.], [3.]])
+        self.assertEqual(results['b'].tolist(), [4.])
+
+    def _check_broadcast(self, num_broadcasts, env=None):
+        initial_values = [
+            np.arange(6, dtype=np.float32).reshape(2, 3),
+            np.array([1, 2], dtype=np.int32),
+            np.array([10., 20.], dtype=np.float32),
+            np.array([0.5, 0.25], dtype=np.float64),
+            np.array([-1.], dtype=np.float32),
+        ]
+        variables = [v1.get_variable('var_%d' % i, initializer=value)
+                     for i, value in enumerate(initial_values)]
+        with mock.patch.dict(os.environ, env or {}):
+            bcast_op = bps.broadcast_variables(variables, root_rank=0)
+        self.assertEqual(len(self.broadcasts), num_broadcasts)
+
+        self.sess.run(v1.global_variables_initializer())
+        self.sess.run(bcast_op)
+        for var, value in zip(variables, initial_values):
+            np.testing.assert_array_equal(self.sess.run(var), value * 2 + 1)
+
+    def test_broadcast_variables(self):
+        # without fusion, one broadcast per variable
+        self._check_broadcast(5)
+
+    def test_broadcast_variables_fusion(self):
+        # the three float32 variables are fused into one broadcast
+        self._check_broadcast(3, {'BYTEPS_TF_GRADIENT_FUSION': '1'})
+
+    def test_broadcast_variables_fusion_threshold(self):
+        # 30 bytes: the 24 bytes of var_0 and the 12 bytes of var_2 and var_4
+        # do not fit in one bucket
+        self._check_broadcast(4, {'BYTEPS_TF_GRADIENT_FUSION': '1',
+                                  'BYTEPS_FUSION_THRESHOLD_MB': str(30 / 1024. / 1024.)})
+
+    def test_bucket_variables(self):
+        variables = [v1.get_variable('var_%d' % i, shape=shape, dtype=dtype)
+                     for i, (shape, dtype) in enumerate([
+                         ([4], tf.float32), ([2], tf.float32), ([2], tf.float32),
+                         ([8], tf.float32), ([2], tf.float32), ([2], tf.bool)])]
+        # 16 bytes per bucket; var_3 is larger and var_5 cannot be fused
+        with mock.patch.dict(os.environ, {'BYTEPS_FUSION_THRESHOLD_MB': str(16 / 1024. / 1024.)}):
+            buckets = bps._bucket_variables(variables)
+        self.assertEqual([[var.name for var in bucket] for bucket in buckets],
+                         [['var_3:0'], ['var_5:0'], ['var_0:0'],
+                          ['var_1:0', 'var_2:0'], ['var_4:0']])
+
+
+if __name__ == '__main__':
+    unittest.main()